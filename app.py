@@ -3,16 +3,47 @@ Streamlit app for dataset generation.
 """
 
 import streamlit as st
+import asyncio
+import cProfile
+import io
 import os
+import pstats
+import tempfile
 from datetime import datetime
+from itertools import islice
+from typing import List
 from dotenv import load_dotenv
 
 from models import ModelManager
+from llm_cache import SEMANTIC_CACHE_AVAILABLE
+from text_processing import TIKTOKEN_AVAILABLE
 from dataset_generator import DatasetGenerator
 from output_formats import OutputFormatter
 
-# Load environment variables
-load_dotenv()
+
+@st.cache_resource
+def load_environment() -> bool:
+    """Load environment variables from .env once per process, not on every rerun."""
+    load_dotenv()
+    return True
+
+
+@st.cache_data
+def get_available_models() -> List[str]:
+    """Cached list of installed AI model providers."""
+    return ModelManager.get_available_models()
+
+
+@st.cache_data
+def get_model_variants(provider: str) -> List[str]:
+    """Cached list of model variants for a provider."""
+    return ModelManager.get_model_variants(provider)
+
+
+@st.cache_data
+def get_available_formats() -> List[str]:
+    """Cached list of output formats."""
+    return OutputFormatter.get_available_formats()
 
 
 def main():
@@ -22,6 +53,9 @@ def main():
         layout="wide"
     )
     
+    # Load environment variables
+    load_environment()
+    
     st.title("📊 Dataset Generator for Fine-tuning")
     st.markdown("Generate training datasets from your text files for fine-tuning language models")
     
@@ -30,7 +64,7 @@ def main():
     
     # Model selection
     st.sidebar.subheader("🤖 AI Model Selection")
-    available_models = ModelManager.get_available_models()
+    available_models = get_available_models()
     
     selected_model = st.sidebar.selectbox(
         "Choose AI Provider",
@@ -40,7 +74,7 @@ def main():
     )
     
     # Specific model selection based on provider
-    model_variants = ModelManager.get_model_variants(selected_model)
+    model_variants = get_model_variants(selected_model)
     specific_model = st.sidebar.selectbox(
         f"Choose {selected_model} Model",
         options=model_variants,
@@ -58,7 +92,14 @@ def main():
     api_key = os.getenv(api_key_map.get(selected_model, ''), '')
     
     if not api_key:
-        st.error(f"Please set your {selected_model} API key in the .env file")
+        api_key = st.sidebar.text_input(
+            f"{selected_model} API Key",
+            type="password",
+            help=f"Not found in .env as {api_key_map.get(selected_model)}; enter it here for this session"
+        )
+    
+    if not api_key:
+        st.error(f"Please set your {selected_model} API key in the .env file or enter it in the sidebar")
         st.stop()
     
     # File upload
@@ -76,14 +117,36 @@ def main():
     # Configuration options
     st.sidebar.subheader("🔧 Generation Settings")
     
-    words_per_chunk = st.sidebar.slider(
-        "Words per chunk",
-        min_value=50,
-        max_value=2000,
-        value=300,
-        step=50,
-        help="Number of words to include in each chunk"
-    )
+    chunk_by_tokens = False
+    if TIKTOKEN_AVAILABLE:
+        chunk_by_tokens = st.sidebar.radio(
+            "Chunk size unit",
+            options=["Words", "Tokens"],
+            horizontal=True,
+            help="Tokens match what the model actually sees, so chunks can be packed closer to the model's limits"
+        ) == "Tokens"
+    
+    tokens_per_chunk = None
+    if chunk_by_tokens:
+        tokens_per_chunk = st.sidebar.slider(
+            "Tokens per chunk",
+            min_value=100,
+            max_value=8000,
+            value=400,
+            step=100,
+            help="Maximum number of tokens to include in each chunk"
+        )
+        # Rough equivalent for the word-based settings
+        words_per_chunk = tokens_per_chunk * 3 // 4
+    else:
+        words_per_chunk = st.sidebar.slider(
+            "Words per chunk",
+            min_value=50,
+            max_value=2000,
+            value=300,
+            step=50,
+            help="Number of words to include in each chunk"
+        )
     
     questions_per_chunk = st.sidebar.slider(
         "Questions per chunk",
@@ -102,11 +165,82 @@ def main():
     
     model_format = st.sidebar.selectbox(
         "Output format",
-        options=OutputFormatter.get_available_formats(),
+        options=get_available_formats(),
         index=0,
         help="Select the format for your target model"
     )
     
+    structured_output = st.sidebar.checkbox(
+        "Structured output (JSON mode)",
+        value=True,
+        help="Ask the model for JSON through its native structured-output mode instead of parsing labelled text"
+    )
+    
+    stream_responses = st.sidebar.checkbox(
+        "Stream responses",
+        value=False,
+        disabled=structured_output,
+        help="Parse conversations and write them to the dataset while the model is still writing its answer (labelled text format only)"
+    )
+    
+    # Throughput options
+    st.sidebar.subheader("⚡ Performance")
+    
+    max_concurrency = st.sidebar.slider(
+        "Concurrent requests",
+        min_value=1,
+        max_value=20,
+        value=5,
+        help="Maximum number of chunks sent to the AI model at the same time"
+    )
+    
+    requests_per_minute = st.sidebar.number_input(
+        "Requests per minute",
+        min_value=1,
+        max_value=10000,
+        value=ModelManager.get_default_rpm(selected_model),
+        step=10,
+        key=f"requests_per_minute_{selected_model}",
+        help="Upper bound on API requests per minute. Match it to your provider's rate limit tier; 429 responses are retried with backoff."
+    )
+    
+    chunks_per_request = st.sidebar.slider(
+        "Chunks per request",
+        min_value=1,
+        max_value=10,
+        value=1,
+        help="Send several chunks in one request to stay under the requests-per-minute limit. Larger values need models with long outputs."
+    )
+    
+    use_cache = st.sidebar.checkbox(
+        "Reuse cached responses",
+        value=True,
+        help="Skip the API call for chunks that were already generated with the same model, prompt and settings"
+    )
+    
+    use_semantic_cache = False
+    if SEMANTIC_CACHE_AVAILABLE:
+        use_semantic_cache = st.sidebar.checkbox(
+            "Reuse answers for near-duplicate chunks",
+            value=use_cache,
+            disabled=not use_cache,
+            help="Reuse the cached answer of a chunk that is almost identical (cosine similarity ≥ 0.95) to one already generated"
+        )
+    
+    use_batch_api = False
+    if ModelManager.supports_batch(selected_model):
+        use_batch_api = st.sidebar.checkbox(
+            "Use Batch API (cheaper, async)",
+            value=False,
+            help="Submit all chunks as one batch job at roughly half the cost. Results can take minutes to hours."
+        )
+    
+    profile_generation = st.sidebar.checkbox(
+        "Profile generation",
+        value=False,
+        help="Show where generation time is spent (cProfile, top 30 functions by cumulative time)"
+    )
+    
     # Custom prompt in main area
     st.subheader("✍️ Custom Generation Prompt")
     st.markdown("""
@@ -126,15 +260,18 @@ def main():
     
     # Initialize generator
     try:
-        generator = DatasetGenerator(selected_model, specific_model, api_key)
+        generator = DatasetGenerator(
+            selected_model, specific_model, api_key,
+            use_cache=use_cache, use_semantic_cache=use_cache and use_semantic_cache,
+            structured_output=structured_output, stream_responses=stream_responses
+        )
         
-        # Read file content
-        text_content = generator.read_file_content(uploaded_file)
+        # Read the file and split it into chunks page by page
+        chunks = list(generator.iter_file_chunks(uploaded_file, words_per_chunk, tokens_per_chunk))
         
-        if text_content:
-            # Split into chunks
-            chunks = generator.split_text_into_chunks(text_content, words_per_chunk)
-            st.info(f"📊 File will be split into {len(chunks)} chunks of ~{words_per_chunk} words each")
+        if chunks:
+            chunk_size = f"{tokens_per_chunk} tokens" if tokens_per_chunk else f"~{words_per_chunk} words"
+            st.info(f"📊 File will be split into {len(chunks)} chunks of up to {chunk_size} each")
             
             if st.button("Generate Dataset", type="primary", use_container_width=True):
                 # Progress tracking
@@ -146,66 +283,88 @@ def main():
                     'questions_per_chunk': questions_per_chunk,
                     'num_exchanges': num_exchanges,
                     'model_format': model_format,
-                    'custom_prompt': custom_prompt
+                    'custom_prompt': custom_prompt,
+                    'max_concurrency': max_concurrency,
+                    'requests_per_minute': requests_per_minute,
+                    'chunks_per_request': chunks_per_request
                 }
                 
-                generated_examples = []
+                def update_progress(completed: int, total: int):
+                    status_text.text(f"Processed chunk {completed}/{total} with {selected_model} ({specific_model})...")
+                    progress_bar.progress(completed / total)
                 
-                for i, chunk in enumerate(chunks):
-                    status_text.text(f"Processing chunk {i+1}/{len(chunks)} with {selected_model} ({specific_model})...")
-                    progress_bar.progress((i + 1) / len(chunks))
-                    
-                    conversations = generator.generate_qa_pairs(
-                        chunk, custom_prompt, questions_per_chunk, num_exchanges
-                    )
-                    
-                    if conversations:
-                        formatted_examples = generator.format_conversations(
-                            conversations, model_format, num_exchanges
-                        )
-                        generated_examples.extend(formatted_examples)
-                    
-                    # Add delay to be respectful to API
-                    import time
-                    time.sleep(1)
+                # Stream examples to a temporary file instead of keeping them all in memory;
+                # a large buffer turns many small chunk writes into few syscalls
+                output_file = tempfile.NamedTemporaryFile(
+                    "wb", buffering=1 << 20, suffix=".jsonl", delete=False
+                )
+                profiler = cProfile.Profile()
+                if profile_generation:
+                    profiler.enable()
+                try:
+                    with output_file:
+                        if use_batch_api:
+                            status_text.text(f"Submitting {len(chunks)} chunks to the {selected_model} Batch API...")
+                            num_examples = generator.generate_dataset_batch(chunks, config, output_file, status_text.text)
+                            progress_bar.progress(1.0)
+                        else:
+                            status_text.text(f"Processing {len(chunks)} chunks with {selected_model} ({specific_model})...")
+                            num_examples = asyncio.run(generator.generate_dataset_async(
+                                chunks, config, output_file, update_progress
+                            ))
+                
+                    status_text.text("Dataset generation complete!")
                 
-                status_text.text("Dataset generation complete!")
+                    if profile_generation:
+                        # Profile only the generation, not the preview and download below
+                        profiler.disable()
+                        stats_output = io.StringIO()
+                        pstats.Stats(profiler, stream=stats_output).sort_stats("cumulative").print_stats(30)
+                        with st.expander("Generation profile"):
+                            st.code(stats_output.getvalue())
                 
-                if generated_examples:
-                    st.success(f"✅ Generated {len(generated_examples)} training examples!")
+                    if num_examples:
+                        st.success(f"✅ Generated {num_examples} training examples!")
                     
-                    # Show sample
-                    with st.expander("Preview generated examples"):
-                        for i, example in enumerate(generated_examples[:3]):
-                            st.write(f"**Example {i+1}:**")
-                            st.code(example, language="json")
-                            st.write("---")
+                        # Show sample
+                        with st.expander("Preview generated examples"):
+                            with open(output_file.name, encoding="utf-8") as f:
+                                for i, example in enumerate(islice(f, 3)):
+                                    st.write(f"**Example {i+1}:**")
+                                    st.code(example.rstrip("\n"), language="json")
+                                    st.write("---")
                     
-                    # Download button
-                    dataset_content = "\n".join(generated_examples)
-                    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                    filename = f"dataset_{model_format.lower()}_{timestamp}.jsonl"
+                        # Download button
+                        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+                        filename = f"dataset_{model_format.lower()}_{timestamp}.jsonl"
                     
-                    st.download_button(
-                        label="📥 Download Dataset",
-                        data=dataset_content,
-                        file_name=filename,
-                        mime="application/json",
-                        use_container_width=True
-                    )
+                        with open(output_file.name, "rb") as f:
+                            st.download_button(
+                                label="📥 Download Dataset",
+                                data=f,
+                                file_name=filename,
+                                mime="application/x-ndjson",
+                                use_container_width=True
+                            )
                     
-                    # Show statistics
-                    st.subheader("📈 Generation Statistics")
-                    col1, col2, col3 = st.columns(3)
-                    with col1:
-                        st.metric("Total Examples", len(generated_examples))
-                    with col2:
-                        st.metric("Chunks Processed", len(chunks))
-                    with col3:
-                        st.metric("Success Rate", f"{len(generated_examples)/(len(chunks)*questions_per_chunk)*100:.1f}%")
+                        # Show statistics
+                        st.subheader("📈 Generation Statistics")
+                        col1, col2, col3 = st.columns(3)
+                        with col1:
+                            st.metric("Total Examples", num_examples)
+                        with col2:
+                            st.metric("Chunks Processed", len(chunks))
+                        with col3:
+                            st.metric("Success Rate", f"{num_examples/(len(chunks)*questions_per_chunk)*100:.1f}%")
                     
-                else:
-                    st.error("No examples were generated. Please check your settings and try again.")
+                    else:
+                        st.error("No examples were generated. Please check your settings and try again.")
+                finally:
+                    # A profiler left enabled after an error would block the next run from profiling
+                    if profile_generation:
+                        profiler.disable()
+                    # The download button has already taken its own copy of the data
+                    os.remove(output_file.name)
         
     except Exception as e:
         st.error(f"Error initializing generator: {e}")
@@ -3,24 +3,134 @@ Core dataset generation logic that ties all components together.
 """
 
 import streamlit as st
+import asyncio
+import io
 import time
-from typing import List, Dict
+from collections import Counter
+from contextlib import asynccontextmanager
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import AsyncIterator, Awaitable, BinaryIO, Callable, Iterable, Iterator, List, Dict, Optional
+from aiolimiter import AsyncLimiter
+from tenacity import (
+    AsyncRetrying, RetryCallState, Retrying, retry_if_exception, retry_if_result,
+    stop_after_attempt, wait_exponential_jitter
+)
 
-from models import ModelManager
+from models import ModelManager, ModelResponse
 from file_handlers import FileHandler
-from text_processing import TextProcessor
+from text_processing import StreamingQAParser, TextProcessor
 from output_formats import OutputFormatter
+from llm_cache import LLMCache, SemanticCache
+
+# Backoff for transient failures when the provider gives no Retry-After hint
+_BACKOFF = wait_exponential_jitter(initial=2, max=60)
+
+
+@st.cache_resource(show_spinner=False)
+def get_client(model_provider: str, specific_model: str, api_key: str):
+    """Create the synchronous SDK client once and reuse it across Streamlit reruns.
+    
+    Async clients are not cached here: their connection pools are bound to the
+    event loop of the run that created them.
+    """
+    return ModelManager.initialize_model(model_provider, specific_model, api_key)
+
+
+@st.cache_resource(show_spinner=False)
+def get_response_cache() -> LLMCache:
+    """Open the on-disk response cache once per process."""
+    return LLMCache()
+
+
+@st.cache_resource(show_spinner=False)
+def get_semantic_cache() -> SemanticCache:
+    """Load the semantic cache (and its stored vectors) once per process."""
+    return SemanticCache()
 
 
 class DatasetGenerator:
     """Main class for generating datasets from text files."""
     
-    def __init__(self, model_provider: str, specific_model: str, api_key: str):
-        """Initialize the dataset generator with selected AI model."""
+    def __init__(self, model_provider: str, specific_model: str, api_key: str,
+                 use_cache: bool = True, use_semantic_cache: bool = False, structured_output: bool = False,
+                 stream_responses: bool = False):
+        """Initialize the dataset generator with selected AI model.
+        
+        With ``structured_output`` the model returns JSON through its native
+        structured-output mode instead of the labelled text format. With
+        ``stream_responses`` text-format responses are streamed and parsed
+        while they arrive.
+        """
         self.model_provider = model_provider
         self.specific_model = specific_model
         self.api_key = api_key
-        self.model = ModelManager.initialize_model(model_provider, specific_model, api_key)
+        self.model = get_client(model_provider, specific_model, api_key)
+        # Opened per event loop by open_async_model
+        self.async_model = None
+        self.cache = get_response_cache() if use_cache else None
+        self.semantic_cache = get_semantic_cache() if use_semantic_cache else None
+        self.structured_output = structured_output
+        self.stream_responses = stream_responses and not structured_output
+        self.max_attempts = 6
+        self.max_parse_retries = 2
+    
+    def _create_prompt_template(self, custom_prompt: str, num_questions: int, num_exchanges: int) -> str:
+        """Create the prompt template for the configured response format."""
+        return TextProcessor.create_prompt_template(
+            custom_prompt, num_questions, num_exchanges, structured_output=self.structured_output
+        )
+    
+    def _response_schema(self, num_exchanges: int) -> Optional[Dict]:
+        """JSON schema to request from the model, or None for the text format."""
+        return TextProcessor.get_response_schema(num_exchanges) if self.structured_output else None
+    
+    def _create_batched_prompt_template(self, custom_prompt: str, num_questions: int, num_exchanges: int,
+                                        num_chunks: int) -> str:
+        """Create the multi-chunk prompt template for the configured response format."""
+        return TextProcessor.create_batched_prompt_template(
+            custom_prompt, num_questions, num_exchanges, num_chunks, structured_output=self.structured_output
+        )
+    
+    def _batched_response_schema(self, num_exchanges: int) -> Optional[Dict]:
+        """JSON schema for a multi-chunk request, or None for the text format."""
+        return TextProcessor.get_batched_response_schema(num_exchanges) if self.structured_output else None
+    
+    def _parse(self, response_text: str, num_exchanges: int) -> List[Dict]:
+        """Parse a response in the configured response format."""
+        if self.structured_output:
+            return TextProcessor.parse_json_response(response_text, num_exchanges)
+        return TextProcessor.parse_qa_response(response_text, num_exchanges)
+    
+    def _get_cached_conversations(self, chunk: str, prompt_template: str, prompt: str, num_exchanges: int) -> List[Dict]:
+        """Return parsed conversations for a previously answered prompt or near-duplicate chunk."""
+        cached_response = None
+        if self.cache is not None:
+            cached_response = self.cache.get(self.model_provider, self.specific_model, prompt)
+        if not cached_response and self.semantic_cache is not None:
+            settings_key = LLMCache.make_key(self.model_provider, self.specific_model, prompt_template)
+            cached_response = self.semantic_cache.get(settings_key, chunk)
+        if not cached_response:
+            return []
+        return self._parse(cached_response, num_exchanges)
+    
+    def _cache_response(self, chunk: str, prompt_template: str, prompt: str, response_text: str):
+        """Remember a response that produced usable conversations."""
+        if self.cache is not None:
+            self.cache.set(self.model_provider, self.specific_model, prompt, response_text)
+        if self.semantic_cache is not None:
+            settings_key = LLMCache.make_key(self.model_provider, self.specific_model, prompt_template)
+            self.semantic_cache.set(settings_key, chunk, response_text)
+    
+    def prepare_cache(self, chunks: List[str]):
+        """Embed all chunks up front so similarity lookups don't embed one at a time."""
+        if self.semantic_cache is not None:
+            self.semantic_cache.embed_many(chunks)
+    
+    def save_cache(self):
+        """Persist cache state that is not written through immediately."""
+        if self.semantic_cache is not None:
+            self.semantic_cache.save()
     
     def read_file_content(self, uploaded_file) -> str:
         """Read content from uploaded file."""
@@ -28,65 +138,502 @@ class DatasetGenerator:
     
     def split_text_into_chunks(self, text: str, words_per_chunk: int) -> List[str]:
         """Split text into chunks."""
-        return TextProcessor.split_by_word_count(text, words_per_chunk)
+        return list(TextProcessor.split_by_word_count(text, words_per_chunk))
+    
+    @asynccontextmanager
+    async def open_async_model(self) -> AsyncIterator:
+        """Open the pooled async SDK client used by the ``*_async`` methods, closing it on exit.
+        
+        The client is bound to the running event loop, so open one per ``asyncio.run``.
+        """
+        self.async_model = ModelManager.initialize_async_model(
+            self.model_provider, self.specific_model, self.api_key
+        )
+        try:
+            yield self.async_model
+        finally:
+            await ModelManager.close_async_model(self.async_model, self.model_provider)
+            self.async_model = None
+    
+    def _require_async_model(self):
+        """Fail loudly, instead of skipping every chunk, when no async client is open."""
+        if self.async_model is None:
+            raise RuntimeError("No async client is open; call this inside 'async with generator.open_async_model()'")
+    
+    def _retry_wait(self, retry_state: RetryCallState) -> float:
+        """Seconds to wait before the next attempt, honoring the server's Retry-After."""
+        error = retry_state.outcome.exception()
+        if error is not None:
+            retry_after = ModelManager.get_retry_after(error)
+            if retry_after is not None:
+                return retry_after
+        return _BACKOFF(retry_state)
+    
+    def _log_retry(self, retry_state: RetryCallState):
+        """Report a failed attempt before sleeping."""
+        error = retry_state.outcome.exception()
+        reason = f"error: {error}" if error is not None else "empty response"
+        st.warning(
+            f"{self.model_provider} request failed ({reason}), retrying in "
+            f"{retry_state.next_action.sleep:.0f}s (attempt {retry_state.attempt_number}/{self.max_attempts})"
+        )
+    
+    def _retry_policy(self) -> Dict:
+        """Tenacity settings shared by the sync and async request paths.
+        
+        Only transient errors and empty responses are retried; anything else
+        (bad API key, invalid request) is raised on the first attempt.
+        """
+        return {
+            "retry": retry_if_exception(ModelManager.is_transient_error) | retry_if_result(lambda response: not response.text),
+            "wait": self._retry_wait,
+            "stop": stop_after_attempt(self.max_attempts),
+            "before_sleep": self._log_retry,
+            # Once attempts run out, return the last (empty) response or raise the last error
+            "retry_error_callback": lambda retry_state: retry_state.outcome.result(),
+        }
+    
+    async def _request_async(self, attempt: Callable[[], Awaitable[ModelResponse]],
+                             rate_limiter: Optional[AsyncLimiter] = None) -> ModelResponse:
+        """Run a request under the retry policy, taking a ``rate_limiter`` slot before every attempt."""
+        async def paced_attempt() -> ModelResponse:
+            if rate_limiter is not None:
+                await rate_limiter.acquire()
+            return await attempt()
+        
+        return await AsyncRetrying(**self._retry_policy())(paced_attempt)
+    
+    def _warn_unparseable(self, prompt: str, parse_attempt: int) -> str:
+        """Report a response with no usable conversations and build the prompt to ask again."""
+        st.warning(
+            f"Could not parse the {self.model_provider} response, asking again "
+            f"(retry {parse_attempt}/{self.max_parse_retries})"
+        )
+        return TextProcessor.create_format_retry_prompt(prompt)
+    
+    def _larger_budget(self, max_tokens: int) -> Optional[int]:
+        """Report a response cut off at ``max_tokens`` and return a larger budget to ask again with, if any.
+        
+        Asking again with the same budget would be cut off in the same place.
+        """
+        ceiling = ModelManager.get_max_output_tokens(self.specific_model)
+        if self.model_provider == "Gemini" or max_tokens >= ceiling:
+            st.warning(
+                f"The {self.model_provider} response was cut off at the model's output limit, skipping this "
+                "chunk; ask for fewer questions or exchanges per chunk"
+            )
+            return None
+        larger = min(2 * max_tokens, ceiling)
+        st.warning(
+            f"The {self.model_provider} response was cut off at {max_tokens} tokens, asking again with {larger}"
+        )
+        return larger
+    
+    def _parse_response(self, chunk: str, prompt_template: str, prompt: str,
+                        response_text: str, num_exchanges: int) -> List[Dict]:
+        """Parse a fresh model response and cache it if it produced conversations."""
+        if not response_text:
+            st.warning(f"Empty response from {self.model_provider}, skipping this chunk")
+            return []
+        conversations = self._parse(response_text, num_exchanges)
+        if conversations:
+            self._cache_response(chunk, prompt_template, prompt, response_text)
+        return conversations
+    
+    def iter_file_chunks(self, uploaded_file, words_per_chunk: int,
+                         tokens_per_chunk: Optional[int] = None) -> Iterator[str]:
+        """Stream an uploaded file into chunks without holding the whole text in memory.
+        
+        Chunks are sized by ``tokens_per_chunk`` when given, else by word count.
+        """
+        pieces = FileHandler.iter_file_text(uploaded_file)
+        if tokens_per_chunk:
+            return TextProcessor.iter_token_chunks(pieces, tokens_per_chunk)
+        return TextProcessor.iter_word_chunks(pieces, words_per_chunk)
     
     def generate_qa_pairs(self, chunk: str, custom_prompt: str, num_questions: int, num_exchanges: int) -> List[Dict]:
         """Generate Q&A pairs for a given chunk using selected AI model."""
-        prompt_template = TextProcessor.create_prompt_template(custom_prompt, num_questions, num_exchanges)
+        prompt_template = self._create_prompt_template(custom_prompt, num_questions, num_exchanges)
         prompt = prompt_template.format(chunk=chunk)
         
-        max_retries = 3
-        for attempt in range(max_retries):
+        cached_conversations = self._get_cached_conversations(chunk, prompt_template, prompt, num_exchanges)
+        if cached_conversations:
+            return cached_conversations
+        
+        request_prompt = prompt
+        max_tokens = ModelManager.get_max_tokens(self.specific_model, 1, num_questions, num_exchanges)
+        for parse_attempt in range(self.max_parse_retries + 1):
             try:
-                response_text = ModelManager.get_model_response(
-                    self.model, self.model_provider, self.specific_model, prompt
+                response = Retrying(**self._retry_policy())(
+                    ModelManager.get_model_response, self.model, self.model_provider, self.specific_model,
+                    request_prompt, self._response_schema(num_exchanges), max_tokens
                 )
-                if response_text:
-                    return TextProcessor.parse_qa_response(response_text, num_exchanges)
-                else:
-                    st.warning(f"Empty response from {self.model_provider} on attempt {attempt + 1}")
             except Exception as e:
-                st.error(f"Error generating Q&A pairs (attempt {attempt + 1}/{max_retries}): {e}")
-                if attempt < max_retries - 1:
-                    time.sleep(3)
-                else:
-                    st.error("Max retries reached, skipping this chunk")
+                st.error(f"Error generating Q&A pairs, skipping this chunk: {e}")
+                return []
+            
+            conversations = self._parse_response(chunk, prompt_template, prompt, response.text, num_exchanges)
+            if conversations or not response.text or parse_attempt == self.max_parse_retries:
+                return conversations
+            if response.truncated:
+                max_tokens = self._larger_budget(max_tokens)
+                if max_tokens is None:
+                    return []
+                request_prompt = prompt
+            else:
+                request_prompt = self._warn_unparseable(prompt, parse_attempt + 1)
+    
+    async def generate_qa_pairs_async(self, chunk: str, custom_prompt: str, num_questions: int, num_exchanges: int,
+                                      rate_limiter: Optional[AsyncLimiter] = None,
+                                      on_conversation: Optional[Callable[[Dict], None]] = None) -> List[Dict]:
+        """Generate Q&A pairs for a given chunk without blocking the event loop.
+        
+        Every attempt, including retries, first takes a slot from ``rate_limiter`` if given.
+        When streaming, ``on_conversation`` is called with each conversation as
+        soon as it has been received; the returned list starts with exactly
+        those conversations. A stream that breaks off after passing some on is
+        not retried, and the chunk keeps just those. Requires an open async
+        client (``open_async_model``).
+        """
+        self._require_async_model()
+        prompt_template = self._create_prompt_template(custom_prompt, num_questions, num_exchanges)
+        prompt = prompt_template.format(chunk=chunk)
+        
+        cached_conversations = self._get_cached_conversations(chunk, prompt_template, prompt, num_exchanges)
+        if cached_conversations:
+            return cached_conversations
         
-        return []
+        # Conversations already passed on; they all come from a single response
+        emitted = []
+        
+        def emit(conversations: List[Dict]):
+            for conversation in conversations:
+                emitted.append(conversation)
+                if on_conversation:
+                    on_conversation(conversation)
+        
+        async def request(request_prompt: str, max_tokens: int) -> ModelResponse:
+            if not self.stream_responses:
+                return await ModelManager.get_model_response_async(
+                    self.async_model, self.model_provider, self.specific_model, request_prompt,
+                    self._response_schema(num_exchanges), max_tokens
+                )
+            
+            # Parse conversations while the rest of the response is still being generated
+            parser = StreamingQAParser(num_exchanges)
+            try:
+                async for delta in ModelManager.stream_model_response_async(
+                    self.async_model, self.model_provider, self.specific_model, request_prompt, max_tokens
+                ):
+                    emit(parser.feed(delta))
+            except Exception as e:
+                if not emitted:
+                    raise
+                # Conversations passed on can't be taken back, so a restarted stream would mix two responses
+                raise RuntimeError(f"response stream broke off after {len(emitted)} conversations: {e}") from e
+            emit(parser.close())
+            return ModelResponse(parser.text)
+        
+        request_prompt = prompt
+        max_tokens = ModelManager.get_max_tokens(self.specific_model, 1, num_questions, num_exchanges)
+        for parse_attempt in range(self.max_parse_retries + 1):
+            try:
+                response = await self._request_async(lambda: request(request_prompt, max_tokens), rate_limiter)
+            except Exception as e:
+                st.error(f"Error generating Q&A pairs, skipping this chunk: {e}")
+                return list(emitted)
+            
+            if emitted:
+                conversations = list(emitted)
+                if response.text:
+                    self._cache_response(chunk, prompt_template, prompt, response.text)
+            else:
+                conversations = self._parse_response(chunk, prompt_template, prompt, response.text, num_exchanges)
+            if conversations or not response.text or parse_attempt == self.max_parse_retries:
+                return conversations
+            if response.truncated:
+                max_tokens = self._larger_budget(max_tokens)
+                if max_tokens is None:
+                    return []
+                request_prompt = prompt
+            else:
+                request_prompt = self._warn_unparseable(prompt, parse_attempt + 1)
+    
+    async def generate_qa_pairs_batched_async(self, chunks: List[str], custom_prompt: str, num_questions: int,
+                                              num_exchanges: int,
+                                              rate_limiter: Optional[AsyncLimiter] = None) -> List[List[Dict]]:
+        """Generate Q&A pairs for several chunks with a single request.
+        
+        Chunks with a cached answer are left out of the request, and each
+        chunk's part of the answer is cached as if it had been asked alone.
+        The output budget grows with the number of chunks, and chunks whose
+        part is missing or unparseable are requested again on their own.
+        Requires an open async client (``open_async_model``). Returns one list
+        of conversations per chunk.
+        """
+        self._require_async_model()
+        prompt_template = self._create_prompt_template(custom_prompt, num_questions, num_exchanges)
+        prompts = [prompt_template.format(chunk=chunk) for chunk in chunks]
+        results = [
+            self._get_cached_conversations(chunk, prompt_template, prompt, num_exchanges)
+            for chunk, prompt in zip(chunks, prompts)
+        ]
+        pending = [i for i, conversations in enumerate(results) if not conversations]
+        
+        if len(pending) == 1:
+            results[pending[0]] = await self.generate_qa_pairs_async(
+                chunks[pending[0]], custom_prompt, num_questions, num_exchanges, rate_limiter=rate_limiter
+            )
+        if len(pending) <= 1:
+            return results
+        
+        batched_prompt = self._create_batched_prompt_template(
+            custom_prompt, num_questions, num_exchanges, len(pending)
+        ).format(chunk=TextProcessor.join_chunks([chunks[i] for i in pending]))
+        
+        try:
+            response = await self._request_async(
+                lambda: ModelManager.get_model_response_async(
+                    self.async_model, self.model_provider, self.specific_model, batched_prompt,
+                    self._batched_response_schema(num_exchanges),
+                    ModelManager.get_max_tokens(self.specific_model, len(pending), num_questions, num_exchanges)
+                ),
+                rate_limiter
+            )
+        except Exception as e:
+            st.error(f"Error generating Q&A pairs, skipping {len(pending)} chunks: {e}")
+            return results
+        
+        # A reply cut off at the token limit, or with a boundary too many or too few,
+        # leaves parts missing or unparseable
+        parts = TextProcessor.split_batched_response(response.text, len(pending), self.structured_output)
+        missing = []
+        for i, part in zip(pending, parts):
+            conversations = self._parse(part, num_exchanges) if part else []
+            if conversations:
+                self._cache_response(chunks[i], prompt_template, prompts[i], part)
+                results[i] = conversations
+            else:
+                missing.append(i)
+        
+        if missing:
+            st.warning(
+                f"{len(missing)} of {len(pending)} chunks had no usable answer in the combined "
+                f"{self.model_provider} response, asking for them one at a time"
+            )
+            # Sequential, so the group still holds a single concurrency slot
+            for i in missing:
+                results[i] = await self.generate_qa_pairs_async(
+                    chunks[i], custom_prompt, num_questions, num_exchanges, rate_limiter=rate_limiter
+                )
+        return results
     
     def format_conversations(self, conversations: List[Dict], model_format: str, num_exchanges: int) -> List[str]:
         """Format conversations for the target model."""
         return OutputFormatter.format_for_model(conversations, model_format, num_exchanges)
     
+    def iter_conversations_jsonl(self, conversations: Iterable[Dict], model_format: str,
+                                 num_exchanges: int) -> Iterator[bytes]:
+        """Lazily format conversations for the target model as JSONL lines."""
+        return OutputFormatter.iter_format_as_jsonl(conversations, model_format, num_exchanges)
+    
     def generate_dataset(self, text_content: str, config: Dict) -> List[str]:
         """Generate complete dataset from text content."""
-        # Extract configuration
-        words_per_chunk = config['words_per_chunk']
-        questions_per_chunk = config['questions_per_chunk']
+        chunks = self.split_text_into_chunks(text_content, config['words_per_chunk'])
+        output = io.BytesIO()
+        asyncio.run(self.generate_dataset_async(chunks, config, output))
+        return output.getvalue().decode("utf-8").splitlines()
+    
+    async def generate_dataset_async(self, chunks: List[str], config: Dict, output: BinaryIO,
+                                     on_progress: Optional[Callable[[int, int], None]] = None) -> int:
+        """Generate Q&A pairs for all chunks concurrently and stream JSONL examples to ``output``.
+        
+        At most ``config['max_concurrency']`` requests are in flight and at most
+        ``config['requests_per_minute']`` are started per minute; each request
+        covers up to ``config['chunks_per_request']`` chunks. Repeated chunks
+        are requested once and their examples written at every occurrence.
+        Examples are written in chunk order as soon as every earlier chunk has
+        finished, so only out-of-order results are held in memory. When
+        streaming, the examples of the earliest unfinished chunk are written as
+        they arrive. Formatting and writing
+        happen on a single background thread so they overlap with the remaining
+        API calls. All requests share one SDK client, whose connections are
+        released when the run ends. Returns the number of examples written.
+        """
         num_exchanges = config['num_exchanges']
-        model_format = config['model_format']
-        custom_prompt = config['custom_prompt']
+        semaphore = asyncio.Semaphore(config.get('max_concurrency', 5))
+        rate_limiter = AsyncLimiter(
+            config.get('requests_per_minute', ModelManager.get_default_rpm(self.model_provider)), 60
+        )
+        
+        chunks_per_request = config.get('chunks_per_request', 1)
+        unique_chunks, sources = TextProcessor.dedupe_chunks(chunks)
+        copies = Counter(sources)
+        last_use = {unique: i for i, unique in enumerate(sources)}
         
-        # Split text into chunks
-        chunks = self.split_text_into_chunks(text_content, words_per_chunk)
+        # Conversations received so far for chunks whose responses are still streaming
+        streamed: Dict[int, List[Dict]] = {}
         
-        # Generate examples
-        generated_examples = []
+        async def process_chunks(start: int):
+            group = unique_chunks[start:start + chunks_per_request]
+            async with semaphore:
+                if len(group) == 1:
+                    on_conversation = None
+                    if self.stream_responses:
+                        streamed[start] = []
+                        
+                        def stream_conversation(conversation: Dict):
+                            streamed[start].append(conversation)
+                            flush()
+                        
+                        on_conversation = stream_conversation
+                    
+                    results = [await self.generate_qa_pairs_async(
+                        group[0], config['custom_prompt'], config['questions_per_chunk'], num_exchanges,
+                        rate_limiter=rate_limiter, on_conversation=on_conversation
+                    )]
+                    streamed.pop(start, None)
+                else:
+                    results = await self.generate_qa_pairs_batched_async(
+                        group, config['custom_prompt'], config['questions_per_chunk'], num_exchanges,
+                        rate_limiter=rate_limiter
+                    )
+            return start, results
         
-        for i, chunk in enumerate(chunks):
-            st.write(f"Processing chunk {i+1}/{len(chunks)} with {self.model_provider} ({self.specific_model})...")
+        def write_conversations(ready: List[List[Dict]]):
+            # Format, serialize and write in one pass; no list of lines is built
+            output.writelines(self.iter_conversations_jsonl(
+                chain.from_iterable(ready), config['model_format'], num_exchanges
+            ))
+        
+        pending_results = {}
+        next_index = 0
+        # Conversations of the chunk at next_index that were written while it was streaming
+        head_written = 0
+        num_examples = 0
+        write_futures = []
+        
+        def flush():
+            """Hand everything that is now in chunk order to the writer as one job."""
+            nonlocal next_index, head_written, num_examples
+            ready = []
+            while next_index < len(chunks):
+                unique = sources[next_index]
+                if unique not in pending_results:
+                    # Still being generated: pass on what has streamed in so far
+                    partial = streamed.get(unique, [])[head_written:]
+                    if partial:
+                        ready.append(partial)
+                        num_examples += len(partial)
+                        head_written += len(partial)
+                    break
+                conversations = pending_results[unique][head_written:]
+                if last_use[unique] == next_index:
+                    del pending_results[unique]
+                if conversations:
+                    ready.append(conversations)
+                    num_examples += len(conversations)
+                head_written = 0
+                next_index += 1
+            if ready:
+                write_futures.append(writer.submit(write_conversations, ready))
+        
+        # One pooled client serves every request of this run and is closed with it
+        async with self.open_async_model():
+            self.prepare_cache(unique_chunks)
+            tasks = [process_chunks(start) for start in range(0, len(unique_chunks), chunks_per_request)]
+            completed = 0
             
-            conversations = self.generate_qa_pairs(
-                chunk, custom_prompt, questions_per_chunk, num_exchanges
-            )
+            # One worker keeps the writes in submission (chunk) order
+            with ThreadPoolExecutor(max_workers=1) as writer:
+                for task in asyncio.as_completed(tasks):
+                    start, results = await task
+                    pending_results.update(enumerate(results, start=start))
+                    completed += sum(copies[unique] for unique in range(start, start + len(results)))
+                    flush()
+                    
+                    if on_progress:
+                        on_progress(completed, len(chunks))
             
-            if conversations:
-                formatted_examples = self.format_conversations(
-                    conversations, model_format, num_exchanges
+            # Surface any error raised while writing
+            for future in wait(write_futures).done:
+                future.result()
+        
+        self.save_cache()
+        return num_examples
+    
+    def generate_dataset_batch(self, chunks: List[str], config: Dict, output: BinaryIO,
+                               on_status: Optional[Callable[[str], None]] = None) -> int:
+        """Generate a dataset through the provider's Batch API and write it to ``output`` as JSONL.
+        
+        Blocks until the batch has finished, polling with exponential backoff.
+        If the batch expired or was cancelled, the results of the requests it
+        did finish are still written. The batch id is kept in the session, so
+        if the page reruns while waiting, asking for the same prompts again
+        resumes the submitted batch instead of paying for a new one. Returns the number of examples written.
+        """
+        num_exchanges = config['num_exchanges']
+        prompt_template = self._create_prompt_template(
+            config['custom_prompt'], config['questions_per_chunk'], num_exchanges
+        )
+        prompts = [prompt_template.format(chunk=chunk) for chunk in chunks]
+        
+        # Only submit prompts that have no cached answer yet
+        self.prepare_cache(chunks)
+        conversations_by_chunk = [
+            self._get_cached_conversations(chunk, prompt_template, prompt, num_exchanges)
+            for chunk, prompt in zip(chunks, prompts)
+        ]
+        pending = [i for i, conversations in enumerate(conversations_by_chunk) if not conversations]
+        
+        if pending:
+            signature = LLMCache.make_key(
+                self.model_provider, self.specific_model, "\n".join(prompts[i] for i in pending)
+            )
+            batch_job = st.session_state.get("batch_job")
+            if batch_job and batch_job["signature"] == signature:
+                batch_id = batch_job["batch_id"]
+            else:
+                batch_id = ModelManager.submit_batch(
+                    self.model, self.model_provider, self.specific_model, [prompts[i] for i in pending],
+                    self._response_schema(num_exchanges),
+                    ModelManager.get_max_tokens(self.specific_model, 1, config['questions_per_chunk'], num_exchanges)
                 )
-                generated_examples.extend(formatted_examples)
+                st.session_state["batch_job"] = {"signature": signature, "batch_id": batch_id}
+            
+            delay = 10
+            while True:
+                status = ModelManager.get_batch_status(self.model, self.model_provider, batch_id)
+                if on_status:
+                    on_status(f"Batch {batch_id} is {status.replace('_', ' ')}...")
+                if status in ("completed", "incomplete"):
+                    break
+                if status == "failed":
+                    st.session_state.pop("batch_job", None)
+                    st.error(f"Batch {batch_id} did not complete")
+                    return 0
+                time.sleep(delay)
+                delay = min(delay * 2, 300)
+            
+            responses = ModelManager.get_batch_results(self.model, self.model_provider, batch_id)
+            st.session_state.pop("batch_job", None)
+            
+            num_missing = sum(f"chunk_{batch_index}" not in responses for batch_index in range(len(pending)))
+            if num_missing:
+                st.warning(f"Batch {batch_id} ended ({status}) without results for {num_missing} of {len(pending)} chunks")
             
-            # Add delay to be respectful to API
-            time.sleep(1)
+            for batch_index, chunk_index in enumerate(pending):
+                response_text = responses.get(f"chunk_{batch_index}")
+                if not response_text:
+                    continue
+                conversations = self._parse(response_text, num_exchanges)
+                if conversations:
+                    self._cache_response(chunks[chunk_index], prompt_template, prompts[chunk_index], response_text)
+                    conversations_by_chunk[chunk_index] = conversations
+            self.save_cache()
         
-        return generated_examples 
\ No newline at end of file
+        output.writelines(self.iter_conversations_jsonl(
+            chain.from_iterable(conversations for conversations in conversations_by_chunk if conversations),
+            config['model_format'], num_exchanges
+        ))
+        return sum(len(conversations) for conversations in conversations_by_chunk if conversations)
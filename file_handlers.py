@@ -2,9 +2,12 @@
 File handling utilities for reading text and PDF files.
 """
 
+import io
 import streamlit as st
 import PyPDF2
-from typing import Union
+import pypdfium2 as pdfium
+from itertools import islice
+from typing import Iterator, Union
 
 
 class FileHandler:
@@ -22,15 +25,73 @@ class FileHandler:
     @staticmethod
     def read_pdf_file(uploaded_file) -> str:
         """Read uploaded PDF file."""
+        # Join once instead of growing a string page by page
+        return "\n".join(FileHandler.iter_pdf_pages(uploaded_file))
+    
+    @staticmethod
+    def iter_text_lines(uploaded_file) -> Iterator[str]:
+        """Yield an uploaded text file line by line, decoding incrementally."""
+        wrapped = io.TextIOWrapper(uploaded_file, encoding="utf-8", errors="replace")
         try:
-            pdf_reader = PyPDF2.PdfReader(uploaded_file)
-            text = ""
-            for page in pdf_reader.pages:
-                text += page.extract_text() + "\n"
-            return text
+            yield from wrapped
+        except Exception as e:
+            st.error(f"Error reading text file: {e}")
+        finally:
+            # Detach so closing the wrapper doesn't close the uploaded file
+            wrapped.detach()
+    
+    @staticmethod
+    def _iter_pdfium_pages(uploaded_file) -> Iterator[str]:
+        """Yield page text using PDFium's native text extraction."""
+        pdf = pdfium.PdfDocument(uploaded_file)
+        try:
+            for page in pdf:
+                textpage = page.get_textpage()
+                try:
+                    yield textpage.get_text_range()
+                finally:
+                    textpage.close()
+                    page.close()
+        finally:
+            pdf.close()
+    
+    @staticmethod
+    def _iter_pypdf2_pages(uploaded_file) -> Iterator[str]:
+        """Yield page text using PyPDF2's pure-Python extraction."""
+        pdf_reader = PyPDF2.PdfReader(uploaded_file)
+        for page in pdf_reader.pages:
+            yield page.extract_text() or ""
+    
+    @staticmethod
+    def iter_pdf_pages(uploaded_file) -> Iterator[str]:
+        """Yield the text of an uploaded PDF one page at a time.
+        
+        Uses pypdfium2, which is several times faster than PyPDF2. If PDFium
+        rejects a malformed file, the remaining pages are read with PyPDF2,
+        which is more lenient.
+        """
+        try:
+            pages_read = 0
+            try:
+                for page_text in FileHandler._iter_pdfium_pages(uploaded_file):
+                    pages_read += 1
+                    yield page_text
+                return
+            except pdfium.PdfiumError:
+                uploaded_file.seek(0)
+            yield from islice(FileHandler._iter_pypdf2_pages(uploaded_file), pages_read, None)
         except Exception as e:
             st.error(f"Error reading PDF file: {e}")
-            return ""
+    
+    @staticmethod
+    def iter_file_text(uploaded_file) -> Iterator[str]:
+        """Yield file content in pieces based on type, without joining it into one string."""
+        if uploaded_file.type == "text/plain":
+            yield from FileHandler.iter_text_lines(uploaded_file)
+        elif uploaded_file.type == "application/pdf":
+            yield from FileHandler.iter_pdf_pages(uploaded_file)
+        else:
+            st.error(f"Unsupported file type: {uploaded_file.type}")
     
     @staticmethod
     def read_file(uploaded_file) -> str:
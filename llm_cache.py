@@ -0,0 +1,171 @@
+"""
+Persistent on-disk cache for AI model responses.
+"""
+
+import bisect
+import hashlib
+import importlib.util
+import json
+import os
+import pickle
+import threading
+import time
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional
+
+import diskcache
+
+# Optional imports: sentence-transformers pulls in torch, so only probe for it
+# here and import it when the embedding model is first loaded
+SEMANTIC_CACHE_AVAILABLE = all(
+    importlib.util.find_spec(name) is not None for name in ("numpy", "sentence_transformers")
+)
+if SEMANTIC_CACHE_AVAILABLE:
+    import numpy as np
+
+
+class LLMCache:
+    """Caches raw model responses keyed by provider, model and prompt."""
+    
+    def __init__(self, directory: str = ".llm_cache", ttl: int = 24 * 60 * 60):
+        """Open (or create) the cache directory; entries expire after ``ttl`` seconds."""
+        self.cache = diskcache.Cache(directory)
+        self.ttl = ttl
+    
+    @staticmethod
+    def make_key(provider: str, specific_model: str, prompt: str) -> str:
+        """Build a stable cache key for a request."""
+        payload = json.dumps(
+            {"provider": provider, "model": specific_model, "prompt": prompt}, ensure_ascii=False, sort_keys=True
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+    
+    def get(self, provider: str, specific_model: str, prompt: str) -> Optional[str]:
+        """Return the cached response for a request, if any."""
+        return self.cache.get(self.make_key(provider, specific_model, prompt))
+    
+    def set(self, provider: str, specific_model: str, prompt: str, response_text: str):
+        """Store the response for a request."""
+        self.cache.set(self.make_key(provider, specific_model, prompt), response_text, expire=self.ttl)
+
+
+@lru_cache(maxsize=1)
+def _load_embedding_model(model_name: str):
+    """Load the sentence embedding model once per process."""
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(model_name)
+
+
+class SemanticCache:
+    """Reuses responses for chunks that are near-duplicates of already answered chunks.
+    
+    Chunks are embedded with a small local sentence-transformers model and
+    compared by cosine similarity. Entries are grouped by a settings key so a
+    response is only reused for the same provider, model and prompt template.
+    One instance is shared by every session, so all access goes through a lock.
+    """
+    
+    def __init__(self, path: str = ".llm_cache/semantic.pkl", threshold: float = 0.95,
+                 model_name: str = "sentence-transformers/all-MiniLM-L6-v2",
+                 ttl: int = 24 * 60 * 60, max_entries: int = 10000):
+        """Load previously stored entries from ``path`` if present.
+        
+        Entries expire after ``ttl`` seconds and only the newest ``max_entries``
+        are kept per settings key.
+        """
+        if not SEMANTIC_CACHE_AVAILABLE:
+            raise ImportError("Semantic caching requires the sentence-transformers package")
+        self.path = path
+        self.threshold = threshold
+        self.model_name = model_name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # Per settings key: a matrix of vectors (with spare rows for appends), responses and creation times
+        self.entries: Dict[str, Dict] = {}
+        self._embeddings: Dict[str, "np.ndarray"] = {}
+        self._dirty = False
+        self._lock = threading.Lock()
+        
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                stored = pickle.load(f)
+            # Entries written in an older layout have no creation times and are dropped
+            self.entries = {
+                key: self._compact(entry) for key, entry in stored.items() if "created" in entry
+            }
+    
+    def _encode(self, chunks: List[str]) -> "np.ndarray":
+        """Embed chunks as normalized vectors in one batched call."""
+        return _load_embedding_model(self.model_name).encode(
+            chunks, batch_size=64, normalize_embeddings=True, convert_to_numpy=True
+        )
+    
+    def embed_many(self, chunks: Iterable[str]):
+        """Embed all chunks not seen yet in one batched call; kept until the next ``save``."""
+        with self._lock:
+            missing = [chunk for chunk in dict.fromkeys(chunks) if chunk not in self._embeddings]
+        if missing:
+            vectors = self._encode(missing)
+            with self._lock:
+                self._embeddings.update(zip(missing, vectors))
+    
+    def _embed(self, chunk: str) -> "np.ndarray":
+        """Return the normalized embedding for a chunk."""
+        with self._lock:
+            vector = self._embeddings.get(chunk)
+        return vector if vector is not None else self._encode([chunk])[0]
+    
+    def _compact(self, entry: Dict, grow: bool = False) -> Dict:
+        """Drop expired and surplus rows, copying the rest into a new matrix.
+        
+        With ``grow`` the matrix gets as many spare rows as kept ones, so
+        appends stay amortized O(1).
+        """
+        created = entry["created"]
+        # Rows are appended in time order, so the expired ones are a prefix
+        start = max(bisect.bisect_left(created, time.time() - self.ttl), len(created) - self.max_entries)
+        size = len(created) - start
+        capacity = max(16, 2 * size) if grow else size
+        matrix = np.empty((capacity, entry["matrix"].shape[1]), dtype=entry["matrix"].dtype)
+        matrix[:size] = entry["matrix"][start:start + size]
+        return {"matrix": matrix, "responses": entry["responses"][start:], "created": created[start:]}
+    
+    def get(self, settings_key: str, chunk: str) -> Optional[str]:
+        """Return the response of the most similar cached chunk above the threshold."""
+        vector = self._embed(chunk)
+        with self._lock:
+            entry = self.entries.get(settings_key)
+            if not entry or not entry["created"]:
+                return None
+            scores = entry["matrix"][:len(entry["created"])] @ vector
+            best = int(np.argmax(scores))
+            if scores[best] >= self.threshold and entry["created"][best] >= time.time() - self.ttl:
+                return entry["responses"][best]
+        return None
+    
+    def set(self, settings_key: str, chunk: str, response_text: str):
+        """Store the response for a chunk."""
+        vector = self._embed(chunk)
+        with self._lock:
+            entry = self.entries.get(settings_key)
+            if entry is None:
+                entry = {"matrix": np.empty((16, vector.shape[0]), dtype=vector.dtype), "responses": [], "created": []}
+            elif len(entry["created"]) == len(entry["matrix"]):
+                entry = self._compact(entry, grow=True)
+            self.entries[settings_key] = entry
+            entry["matrix"][len(entry["created"])] = vector
+            entry["responses"].append(response_text)
+            entry["created"].append(time.time())
+            self._dirty = True
+    
+    def save(self):
+        """Persist unexpired entries to disk if anything changed, and forget the chunk embeddings of the run."""
+        with self._lock:
+            self._embeddings.clear()
+            if not self._dirty:
+                return
+            self.entries = {key: self._compact(entry) for key, entry in self.entries.items()}
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path, "wb") as f:
+                pickle.dump(self.entries, f)
+            self._dirty = False
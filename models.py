@@ -3,21 +3,45 @@ AI Model integrations for dataset generation.
 Handles Gemini, Claude, and OpenAI models.
 """
 
-import google.generativeai as genai
-from typing import Dict, List
+import asyncio
+import importlib.util
+import json
+import sys
+from typing import AsyncIterator, Dict, List, NamedTuple, Optional
 
-# Optional imports with error handling
-try:
-    import anthropic
-    ANTHROPIC_AVAILABLE = True
-except ImportError:
-    ANTHROPIC_AVAILABLE = False
+# Provider SDKs are imported when a client is first created, so startup only
+# pays for the provider actually in use. Probing with find_spec doesn't import.
+ANTHROPIC_AVAILABLE = importlib.util.find_spec("anthropic") is not None
+OPENAI_AVAILABLE = importlib.util.find_spec("openai") is not None
+# HTTP/2 lets concurrent requests share one TLS connection; httpx needs h2 for it
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
 
-try:
-    import openai
-    OPENAI_AVAILABLE = True
-except ImportError:
-    OPENAI_AVAILABLE = False
+# Errors worth retrying, by SDK module: rate limits, timeouts, dropped connections and 5xx responses
+TRANSIENT_ERROR_NAMES = {
+    "google.api_core.exceptions": ("ResourceExhausted", "ServiceUnavailable", "DeadlineExceeded", "InternalServerError"),
+    "anthropic": ("RateLimitError", "APIConnectionError", "InternalServerError"),
+    "openai": ("RateLimitError", "APIConnectionError", "InternalServerError"),
+}
+
+# Output token budget of a single-chunk request, raised for requests asking for many exchanges
+DEFAULT_MAX_TOKENS = 4000
+TOKENS_PER_EXCHANGE = 400
+# Largest output budget to ask each model for. Claude is kept under the size
+# its SDK refuses to send without streaming.
+MAX_OUTPUT_TOKENS = {
+    "claude-sonnet-4-20250514": 16000,
+    "claude-3-5-haiku-20241022": 8192,
+    "claude-3-7-sonnet-latest": 16000,
+    "gpt-4o": 16384,
+    "gpt-4o-mini": 16384,
+    "o3-mini": 16384,
+}
+
+
+class ModelResponse(NamedTuple):
+    """Text of a model reply, and whether it was cut off at the output token limit."""
+    text: str
+    truncated: bool = False
 
 
 class ModelManager:
@@ -45,58 +69,409 @@ class ModelManager:
         else:
             return []
     
+    @staticmethod
+    def get_default_rpm(provider: str) -> int:
+        """Get a conservative default requests-per-minute limit for a provider."""
+        if provider == "Gemini":
+            return 500
+        elif provider == "Claude":
+            return 50
+        elif provider == "OpenAI":
+            return 500
+        else:
+            return 60
+    
+    @staticmethod
+    def get_max_tokens(specific_model: str, num_chunks: int = 1, num_questions: int = 0,
+                       num_exchanges: int = 1) -> int:
+        """Get the output token budget for a request covering ``num_chunks`` chunks.
+        
+        Each chunk gets room for ``num_questions`` conversations of ``num_exchanges``
+        exchanges, and at least the default budget, up to the model's ceiling.
+        """
+        per_chunk = max(DEFAULT_MAX_TOKENS, TOKENS_PER_EXCHANGE * num_questions * num_exchanges)
+        return min(per_chunk * num_chunks, ModelManager.get_max_output_tokens(specific_model))
+    
+    @staticmethod
+    def get_max_output_tokens(specific_model: str) -> int:
+        """Get the largest output token budget to ask a model for."""
+        return MAX_OUTPUT_TOKENS.get(specific_model, DEFAULT_MAX_TOKENS)
+    
+    @staticmethod
+    def is_rate_limit_error(error: Exception) -> bool:
+        """Check whether an SDK exception is an HTTP 429 / quota error."""
+        # openai and anthropic expose status_code, google.api_core exposes code
+        return getattr(error, "status_code", None) == 429 or getattr(error, "code", None) == 429
+    
+    @staticmethod
+    def is_transient_error(error: Exception) -> bool:
+        """Check whether a request that raised ``error`` may succeed if retried.
+        
+        Authentication and invalid-request errors are permanent and fail fast.
+        """
+        for module_name, error_names in TRANSIENT_ERROR_NAMES.items():
+            # An SDK that was never imported can't have raised the error
+            module = sys.modules.get(module_name)
+            if module is not None and isinstance(error, tuple(getattr(module, name) for name in error_names)):
+                return True
+        status_code = getattr(error, "status_code", None)
+        return ModelManager.is_rate_limit_error(error) or (isinstance(status_code, int) and status_code >= 500)
+    
+    @staticmethod
+    def get_retry_after(error: Exception) -> Optional[float]:
+        """Get the server-suggested delay in seconds from a rate limit error, if any."""
+        response = getattr(error, "response", None)
+        headers = getattr(response, "headers", None)
+        if not headers:
+            return None
+        try:
+            return float(headers.get("retry-after"))
+        except (TypeError, ValueError):
+            return None
+    
     @staticmethod
     def initialize_model(provider: str, specific_model: str, api_key: str):
         """Initialize a model instance."""
         if provider == "Gemini":
+            import google.generativeai as genai
             genai.configure(api_key=api_key)
             return genai.GenerativeModel(specific_model)
         elif provider == "Claude" and ANTHROPIC_AVAILABLE:
+            import anthropic
             return anthropic.Anthropic(api_key=api_key)
         elif provider == "OpenAI" and OPENAI_AVAILABLE:
+            import openai
             return openai.OpenAI(api_key=api_key)
         else:
             raise ValueError(f"Unsupported model provider: {provider}")
     
     @staticmethod
-    def get_model_response(model, provider: str, specific_model: str, prompt: str) -> str:
-        """Get response from the selected AI model."""
+    def initialize_async_model(provider: str, specific_model: str, api_key: str):
+        """Initialize an asyncio-compatible model instance.
+        
+        The Claude and OpenAI clients keep one pooled HTTP connection set
+        (multiplexed over HTTP/2 when h2 is installed) for all requests of a run.
+        """
+        if provider == "Gemini":
+            import google.generativeai as genai
+            genai.configure(api_key=api_key)
+            return genai.GenerativeModel(specific_model)
+        elif provider == "Claude" and ANTHROPIC_AVAILABLE:
+            import anthropic
+            return anthropic.AsyncAnthropic(
+                api_key=api_key, http_client=anthropic.DefaultAsyncHttpxClient(http2=HTTP2_AVAILABLE)
+            )
+        elif provider == "OpenAI" and OPENAI_AVAILABLE:
+            import openai
+            return openai.AsyncOpenAI(
+                api_key=api_key, http_client=openai.DefaultAsyncHttpxClient(http2=HTTP2_AVAILABLE)
+            )
+        else:
+            raise ValueError(f"Unsupported model provider: {provider}")
+    
+    @staticmethod
+    async def close_async_model(model, provider: str):
+        """Close the connection pool of an asyncio-compatible model instance."""
+        if provider in ("Claude", "OpenAI"):
+            await model.close()
+    
+    @staticmethod
+    def _claude_request_params(specific_model: str, prompt: str, response_schema: Optional[Dict] = None,
+                               max_tokens: int = DEFAULT_MAX_TOKENS) -> Dict:
+        """Build the Messages API parameters for a Claude request.
+        
+        With a ``response_schema``, Claude is forced to answer through a tool
+        whose input is the structured result.
+        """
+        params = {
+            "model": specific_model,
+            "max_tokens": max_tokens,
+            "messages": [
+                {"role": "user", "content": prompt}
+            ]
+        }
+        if response_schema:
+            params["tools"] = [{
+                "name": "emit_conversations",
+                "description": "Return the generated conversations.",
+                "input_schema": response_schema
+            }]
+            params["tool_choice"] = {"type": "tool", "name": "emit_conversations"}
+        return params
+    
+    @staticmethod
+    def _openai_request_params(specific_model: str, prompt: str, response_schema: Optional[Dict] = None,
+                               max_tokens: int = DEFAULT_MAX_TOKENS) -> Dict:
+        """Build the Chat Completions parameters for an OpenAI request."""
+        params = {
+            "model": specific_model,
+            "messages": [
+                {"role": "user", "content": prompt}
+            ]
+        }
+        # Handle different parameter requirements for different OpenAI models
+        if "o1-" in specific_model or "o3-" in specific_model:
+            # o1 and o3 models use max_completion_tokens instead of max_tokens
+            params["max_completion_tokens"] = max_tokens
+        else:
+            # Standard GPT models use max_tokens
+            params["max_tokens"] = max_tokens
+            params["temperature"] = 0.7
+        if response_schema:
+            params["response_format"] = {
+                "type": "json_schema",
+                "json_schema": {
+                    "name": "conversations",
+                    "strict": True,
+                    "schema": ModelManager._strict_schema(response_schema)
+                }
+            }
+        return params
+    
+    @staticmethod
+    def _strict_schema(schema: Dict) -> Dict:
+        """Add the ``additionalProperties: false`` markers OpenAI's strict mode requires."""
+        strict = dict(schema)
+        if strict.get("type") == "object":
+            strict["additionalProperties"] = False
+            strict["properties"] = {
+                name: ModelManager._strict_schema(prop) for name, prop in strict.get("properties", {}).items()
+            }
+        elif strict.get("type") == "array":
+            strict["items"] = ModelManager._strict_schema(strict["items"])
+        return strict
+    
+    @staticmethod
+    def _gemini_generation_config(response_schema: Optional[Dict] = None) -> Optional[Dict]:
+        """Build the Gemini generation config for JSON-mode requests."""
+        if not response_schema:
+            return None
+        return {"response_mime_type": "application/json", "response_schema": response_schema}
+    
+    @staticmethod
+    def _claude_response_text(content) -> str:
+        """Get the text of a Claude reply, serializing tool input for structured requests."""
+        for block in content or []:
+            if block.type == "tool_use":
+                return json.dumps(block.input, ensure_ascii=False)
+            if block.type == "text":
+                return block.text
+        return ""
+    
+    @staticmethod
+    def _gemini_response(response) -> ModelResponse:
+        """Get the text of a Gemini reply and whether it hit the output token limit."""
+        finish_reason = response.candidates[0].finish_reason if response.candidates else None
+        return ModelResponse(
+            response.text if response.text else "",
+            getattr(finish_reason, "name", finish_reason) == "MAX_TOKENS"
+        )
+    
+    @staticmethod
+    def _claude_response(response) -> ModelResponse:
+        """Get the text of a Claude reply and whether it hit the output token limit."""
+        return ModelResponse(ModelManager._claude_response_text(response.content), response.stop_reason == "max_tokens")
+    
+    @staticmethod
+    def _openai_response(response) -> ModelResponse:
+        """Get the text of an OpenAI reply and whether it hit the output token limit."""
+        if not response.choices:
+            return ModelResponse("")
+        choice = response.choices[0]
+        return ModelResponse(choice.message.content or "", choice.finish_reason == "length")
+    
+    @staticmethod
+    def get_model_response(model, provider: str, specific_model: str, prompt: str,
+                           response_schema: Optional[Dict] = None,
+                           max_tokens: int = DEFAULT_MAX_TOKENS) -> ModelResponse:
+        """Get response from the selected AI model.
+        
+        When ``response_schema`` is given the model is asked for JSON matching it,
+        using each provider's native structured-output mode. ``max_tokens`` caps
+        the Claude and OpenAI output; Gemini uses the model's own limit.
+        """
         if provider == "Gemini":
-            response = model.generate_content(prompt)
-            return response.text if response.text else ""
+            response = model.generate_content(
+                prompt, generation_config=ModelManager._gemini_generation_config(response_schema)
+            )
+            return ModelManager._gemini_response(response)
         
         elif provider == "Claude":
             response = model.messages.create(
-                model=specific_model,
-                max_tokens=4000,
-                messages=[
-                    {"role": "user", "content": prompt}
-                ]
+                **ModelManager._claude_request_params(specific_model, prompt, response_schema, max_tokens)
             )
-            return response.content[0].text if response.content else ""
+            return ModelManager._claude_response(response)
         
         elif provider == "OpenAI":
-            # Handle different parameter requirements for different OpenAI models
-            if "o1-" in specific_model or "o3-" in specific_model:
-                # o1 and o3 models use max_completion_tokens instead of max_tokens
-                response = model.chat.completions.create(
-                    model=specific_model,
-                    messages=[
-                        {"role": "user", "content": prompt}
-                    ],
-                    max_completion_tokens=4000
-                )
-            else:
-                # Standard GPT models use max_tokens
-                response = model.chat.completions.create(
-                    model=specific_model,
-                    messages=[
-                        {"role": "user", "content": prompt}
-                    ],
-                    max_tokens=4000,
-                    temperature=0.7
-                )
-            return response.choices[0].message.content if response.choices else ""
+            response = model.chat.completions.create(
+                **ModelManager._openai_request_params(specific_model, prompt, response_schema, max_tokens)
+            )
+            return ModelManager._openai_response(response)
+        
+        else:
+            raise ValueError(f"Unsupported model provider: {provider}")
+    
+    @staticmethod
+    async def get_model_response_async(model, provider: str, specific_model: str, prompt: str,
+                                       response_schema: Optional[Dict] = None,
+                                       max_tokens: int = DEFAULT_MAX_TOKENS) -> ModelResponse:
+        """Get response from the selected AI model without blocking the event loop.
+        
+        ``max_tokens`` caps the Claude and OpenAI output; Gemini uses the model's own limit.
+        """
+        if provider == "Gemini":
+            # The Gemini SDK's async client is bound to the first event loop it
+            # sees, so run the blocking call in a worker thread instead.
+            response = await asyncio.to_thread(
+                model.generate_content, prompt,
+                generation_config=ModelManager._gemini_generation_config(response_schema)
+            )
+            return ModelManager._gemini_response(response)
+        
+        elif provider == "Claude":
+            response = await model.messages.create(
+                **ModelManager._claude_request_params(specific_model, prompt, response_schema, max_tokens)
+            )
+            return ModelManager._claude_response(response)
+        
+        elif provider == "OpenAI":
+            response = await model.chat.completions.create(
+                **ModelManager._openai_request_params(specific_model, prompt, response_schema, max_tokens)
+            )
+            return ModelManager._openai_response(response)
+        
+        else:
+            raise ValueError(f"Unsupported model provider: {provider}")
+    
+    @staticmethod
+    async def stream_model_response_async(model, provider: str, specific_model: str, prompt: str,
+                                          max_tokens: int = DEFAULT_MAX_TOKENS) -> AsyncIterator[str]:
+        """Yield the text of a response from the selected AI model as it is generated."""
+        if provider == "Gemini":
+            # Pull each streamed piece in a worker thread, like the non-streaming call
+            response = await asyncio.to_thread(model.generate_content, prompt, stream=True)
+            pieces = iter(response)
+            while (piece := await asyncio.to_thread(next, pieces, None)) is not None:
+                if piece.text:
+                    yield piece.text
+        
+        elif provider == "Claude":
+            async with model.messages.stream(
+                **ModelManager._claude_request_params(specific_model, prompt, max_tokens=max_tokens)
+            ) as stream:
+                async for text in stream.text_stream:
+                    yield text
+        
+        elif provider == "OpenAI":
+            stream = await model.chat.completions.create(
+                **ModelManager._openai_request_params(specific_model, prompt, max_tokens=max_tokens), stream=True
+            )
+            async for event in stream:
+                if event.choices and event.choices[0].delta.content:
+                    yield event.choices[0].delta.content
         
         else:
-            raise ValueError(f"Unsupported model provider: {provider}") 
\ No newline at end of file
+            raise ValueError(f"Unsupported model provider: {provider}")
+    
+    @staticmethod
+    def supports_batch(provider: str) -> bool:
+        """Check whether a provider offers a discounted asynchronous Batch API."""
+        return provider in ("Claude", "OpenAI")
+    
+    @staticmethod
+    def submit_batch(model, provider: str, specific_model: str, prompts: List[str],
+                     response_schema: Optional[Dict] = None, max_tokens: int = DEFAULT_MAX_TOKENS) -> str:
+        """Submit prompts as one Batch API job and return the batch id.
+        
+        Each prompt is tagged with a ``chunk_<index>`` custom id so results can
+        be mapped back to their position in ``prompts``.
+        """
+        if provider == "OpenAI":
+            lines = [
+                json.dumps({
+                    "custom_id": f"chunk_{i}",
+                    "method": "POST",
+                    "url": "/v1/chat/completions",
+                    "body": ModelManager._openai_request_params(specific_model, prompt, response_schema, max_tokens)
+                }, ensure_ascii=False)
+                for i, prompt in enumerate(prompts)
+            ]
+            batch_file = model.files.create(
+                file=("batch_input.jsonl", "\n".join(lines).encode("utf-8")),
+                purpose="batch"
+            )
+            batch = model.batches.create(
+                input_file_id=batch_file.id,
+                endpoint="/v1/chat/completions",
+                completion_window="24h"
+            )
+            return batch.id
+        
+        elif provider == "Claude":
+            batch = model.messages.batches.create(
+                requests=[
+                    {
+                        "custom_id": f"chunk_{i}",
+                        "params": ModelManager._claude_request_params(specific_model, prompt, response_schema, max_tokens)
+                    }
+                    for i, prompt in enumerate(prompts)
+                ]
+            )
+            return batch.id
+        
+        else:
+            raise ValueError(f"Batch API not supported for provider: {provider}")
+    
+    @staticmethod
+    def get_batch_status(model, provider: str, batch_id: str) -> str:
+        """Get the status of a batch job: "in_progress", "completed", "incomplete" or "failed".
+        
+        An "incomplete" batch stopped early (expired or cancelled); the requests
+        it finished are billed and their results can still be downloaded.
+        """
+        if provider == "OpenAI":
+            status = model.batches.retrieve(batch_id).status
+            if status == "completed":
+                return "completed"
+            if status in ("expired", "cancelled"):
+                return "incomplete"
+            if status == "failed":
+                return "failed"
+            return "in_progress"
+        
+        elif provider == "Claude":
+            status = model.messages.batches.retrieve(batch_id).processing_status
+            return "completed" if status == "ended" else "in_progress"
+        
+        else:
+            raise ValueError(f"Batch API not supported for provider: {provider}")
+    
+    @staticmethod
+    def get_batch_results(model, provider: str, batch_id: str) -> Dict[str, str]:
+        """Download the results of a finished batch job, keyed by custom id; failed requests are left out."""
+        results = {}
+        
+        if provider == "OpenAI":
+            batch = model.batches.retrieve(batch_id)
+            if not batch.output_file_id:
+                return results
+            for line in model.files.content(batch.output_file_id).text.splitlines():
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                response = entry.get("response") or {}
+                if response.get("status_code") != 200:
+                    continue
+                choices = response.get("body", {}).get("choices") or []
+                if choices:
+                    results[entry["custom_id"]] = choices[0]["message"]["content"] or ""
+        
+        elif provider == "Claude":
+            for entry in model.messages.batches.results(batch_id):
+                if entry.result.type == "succeeded":
+                    results[entry.custom_id] = ModelManager._claude_response_text(entry.result.message.content)
+        
+        else:
+            raise ValueError(f"Batch API not supported for provider: {provider}")
+        
+        return results
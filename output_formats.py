@@ -3,96 +3,152 @@ Output format handlers for different model types.
 """
 
 import json
-from typing import List, Dict
+from typing import Callable, Iterable, Iterator, List, Dict, Tuple
+
+# Optional imports with error handling
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+from text_processing import TextProcessor
 
 
 class OutputFormatter:
     """Handles formatting conversations for different model types."""
     
+    # Chat-template formats: (prefix, (before question, between question and answer, after answer),
+    # separator between turns). Turns are joined from these fixed pieces, so no template is parsed per example.
+    _TEXT_TEMPLATES = {
+        "Gemma": (
+            "",
+            ("<start_of_turn>user\n", "<end_of_turn>\n<start_of_turn>model\n", "<end_of_turn>"),
+            "\n"
+        ),
+        "Llama": (
+            "<|begin_of_text|>",
+            ("<|start_header_id|>user<|end_header_id|>\n\n",
+             "<|eot_id|><|start_header_id|>assistant<|end_header_id|>\n\n", "<|eot_id|>"),
+            ""
+        ),
+        "ChatML": (
+            "",
+            ("<|im_start|>user\n", "<|im_end|>\n<|im_start|>assistant\n", "<|im_end|>"),
+            "\n"
+        ),
+    }
+    
     @staticmethod
     def get_available_formats() -> List[str]:
         """Get list of available output formats."""
-        return ["Gemma", "Llama", "OpenAI", "Alpaca"]
+        return ["Gemma", "Llama", "ChatML", "OpenAI", "Alpaca", "ShareGPT", "Generic"]
+    
+    @staticmethod
+    def get_formatter(model_format: str) -> Callable[[Dict, int], Dict]:
+        """Look up the function that formats one conversation for the selected model format."""
+        return FORMATTERS.get(model_format, OutputFormatter._format_generic)
     
     @staticmethod
     def format_for_model(conversations: List[Dict], model_format: str, num_exchanges: int) -> List[str]:
         """Format conversation pairs based on the selected model format."""
-        formatted_examples = []
-        
+        return [
+            line.decode("utf-8").rstrip("\n")
+            for line in OutputFormatter.iter_format_as_jsonl(conversations, model_format, num_exchanges)
+        ]
+    
+    @staticmethod
+    def iter_format_as_jsonl(conversations: Iterable[Dict], model_format: str, num_exchanges: int) -> Iterator[bytes]:
+        """Lazily format conversation pairs as newline-terminated JSONL lines, one per conversation."""
+        format_one = OutputFormatter.get_formatter(model_format)
         for conv in conversations:
-            if model_format == "Gemma":
-                conversation = OutputFormatter._format_gemma(conv, num_exchanges)
-            elif model_format == "Llama":
-                conversation = OutputFormatter._format_llama(conv, num_exchanges)
-            elif model_format == "OpenAI":
-                conversation = OutputFormatter._format_openai(conv, num_exchanges)
-            elif model_format == "Alpaca":
-                conversation = OutputFormatter._format_alpaca(conv, num_exchanges)
-            else:  # Default format
-                conversation = conv
-            
-            formatted_examples.append(json.dumps(conversation, ensure_ascii=False))
-        
-        return formatted_examples
+            yield OutputFormatter._dump_line(format_one(conv, num_exchanges))
+    
+    @staticmethod
+    def _dump_line(example: Dict) -> bytes:
+        """Serialize one example as a compact UTF-8 JSON line, with orjson when installed."""
+        if ORJSON_AVAILABLE:
+            return orjson.dumps(example, option=orjson.OPT_APPEND_NEWLINE)
+        return (json.dumps(example, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+    
+    @staticmethod
+    def _turns(conv: Dict, num_exchanges: int) -> List[Tuple[str, str]]:
+        """Get the (question, answer) turns of a conversation in order."""
+        turns = [(conv['question'], conv['answer'])]
+        for question_key, answer_key in TextProcessor.followup_keys(num_exchanges):
+            turns.append((conv[question_key], conv[answer_key]))
+        return turns
+    
+    @staticmethod
+    def _format_text(conv: Dict, model_format: str, num_exchanges: int) -> Dict:
+        """Render a conversation with a precomputed chat template."""
+        prefix, (user_start, model_start, turn_end), separator = OutputFormatter._TEXT_TEMPLATES[model_format]
+        turns = OutputFormatter._turns(conv, num_exchanges)
+        return {
+            "text": prefix + separator.join(
+                "".join((user_start, question, model_start, answer, turn_end)) for question, answer in turns
+            )
+        }
     
     @staticmethod
     def _format_gemma(conv: Dict, num_exchanges: int) -> Dict:
         """Format for Gemma model."""
-        if num_exchanges == 1:
-            return {
-                "text": f"<start_of_turn>user\n{conv['question']}<end_of_turn>\n<start_of_turn>model\n{conv['answer']}<end_of_turn>"
-            }
-        else:
-            return {
-                "text": f"<start_of_turn>user\n{conv['question']}<end_of_turn>\n<start_of_turn>model\n{conv['answer']}<end_of_turn>\n<start_of_turn>user\n{conv['followup_question']}<end_of_turn>\n<start_of_turn>model\n{conv['followup_answer']}<end_of_turn>"
-            }
+        return OutputFormatter._format_text(conv, "Gemma", num_exchanges)
     
     @staticmethod
     def _format_llama(conv: Dict, num_exchanges: int) -> Dict:
         """Format for Llama model."""
-        if num_exchanges == 1:
-            return {
-                "text": f"<|begin_of_text|><|start_header_id|>user<|end_header_id|>\n\n{conv['question']}<|eot_id|><|start_header_id|>assistant<|end_header_id|>\n\n{conv['answer']}<|eot_id|>"
-            }
-        else:
-            return {
-                "text": f"<|begin_of_text|><|start_header_id|>user<|end_header_id|>\n\n{conv['question']}<|eot_id|><|start_header_id|>assistant<|end_header_id|>\n\n{conv['answer']}<|eot_id|><|start_header_id|>user<|end_header_id|>\n\n{conv['followup_question']}<|eot_id|><|start_header_id|>assistant<|end_header_id|>\n\n{conv['followup_answer']}<|eot_id|>"
-            }
+        return OutputFormatter._format_text(conv, "Llama", num_exchanges)
+    
+    @staticmethod
+    def _format_chatml(conv: Dict, num_exchanges: int) -> Dict:
+        """Format for ChatML-based models."""
+        return OutputFormatter._format_text(conv, "ChatML", num_exchanges)
     
     @staticmethod
     def _format_openai(conv: Dict, num_exchanges: int) -> Dict:
         """Format for OpenAI model."""
-        if num_exchanges == 1:
-            return {
-                "messages": [
-                    {"role": "user", "content": conv['question']},
-                    {"role": "assistant", "content": conv['answer']}
-                ]
-            }
-        else:
-            return {
-                "messages": [
-                    {"role": "user", "content": conv['question']},
-                    {"role": "assistant", "content": conv['answer']},
-                    {"role": "user", "content": conv['followup_question']},
-                    {"role": "assistant", "content": conv['followup_answer']}
-                ]
-            }
+        messages = []
+        for question, answer in OutputFormatter._turns(conv, num_exchanges):
+            messages.append({"role": "user", "content": question})
+            messages.append({"role": "assistant", "content": answer})
+        return {"messages": messages}
     
     @staticmethod
     def _format_alpaca(conv: Dict, num_exchanges: int) -> Dict:
         """Format for Alpaca model."""
-        if num_exchanges == 1:
-            return {
-                "instruction": conv['question'],
-                "input": "",
-                "output": conv['answer']
-            }
-        else:
-            return {
-                "instruction": conv['question'],
-                "input": "",
-                "output": conv['answer'],
-                "follow_up_instruction": conv['followup_question'],
-                "follow_up_output": conv['followup_answer']
-            } 
\ No newline at end of file
+        example = {
+            "instruction": conv['question'],
+            "input": "",
+            "output": conv['answer']
+        }
+        for i, (question_key, answer_key) in enumerate(TextProcessor.followup_keys(num_exchanges), start=1):
+            suffix = "" if i == 1 else f"_{i}"
+            example[f"follow_up_instruction{suffix}"] = conv[question_key]
+            example[f"follow_up_output{suffix}"] = conv[answer_key]
+        return example
+    
+    @staticmethod
+    def _format_sharegpt(conv: Dict, num_exchanges: int) -> Dict:
+        """Format for ShareGPT-style conversation datasets."""
+        messages = []
+        for question, answer in OutputFormatter._turns(conv, num_exchanges):
+            messages.append({"from": "human", "value": question})
+            messages.append({"from": "gpt", "value": answer})
+        return {"conversations": messages}
+    
+    @staticmethod
+    def _format_generic(conv: Dict, num_exchanges: int) -> Dict:
+        """Generic format: the parsed conversation as is."""
+        return conv
+
+
+# Per-conversation formatter for each output format; any other format is Generic
+FORMATTERS: Dict[str, Callable[[Dict, int], Dict]] = {
+    "Gemma": OutputFormatter._format_gemma,
+    "Llama": OutputFormatter._format_llama,
+    "ChatML": OutputFormatter._format_chatml,
+    "OpenAI": OutputFormatter._format_openai,
+    "Alpaca": OutputFormatter._format_alpaca,
+    "ShareGPT": OutputFormatter._format_sharegpt,
+}
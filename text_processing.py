@@ -2,30 +2,167 @@
 Text processing utilities for chunking and parsing responses.
 """
 
+import hashlib
+import json
 import re
-from typing import List, Dict
+from functools import lru_cache
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+# Optional imports with error handling
+try:
+    import tiktoken
+    TIKTOKEN_AVAILABLE = True
+except ImportError:
+    TIKTOKEN_AVAILABLE = False
+
+
+# Matches text up to (but never across) the next CONVERSATION marker
+_SECTION = r'(?:(?!CONVERSATION).)*'
+
+
+@lru_cache(maxsize=1)
+def _get_encoding():
+    """Load the tokenizer once per process; building it is expensive."""
+    return tiktoken.get_encoding("cl100k_base")
+
+
+@lru_cache(maxsize=65536)
+def _count_word_tokens(word: str) -> int:
+    """Count the tokens of a word as it appears after a space; words repeat, so counts are cached."""
+    return len(_get_encoding().encode_ordinary(" " + word))
 
 
 class TextProcessor:
     """Handles text processing tasks."""
     
+    # Separates the chunks of a multi-chunk prompt and the answers to them
+    CHUNK_BOUNDARY = "===CHUNK-BOUNDARY==="
+    
+    # Response patterns, compiled once and matched in a single pass per response
+    _CONVERSATION = re.compile(
+        rf'CONVERSATION{_SECTION}?QUESTION:\s*(?P<question>{_SECTION}?)ANSWER:\s*(?P<answer>{_SECTION})',
+        re.DOTALL
+    )
+    # One follow-up turn inside a conversation; labels may carry a number ("FOLLOW-UP 2:").
+    # Only the labels end a section, so answers may mention "FOLLOW-UP" themselves.
+    _FOLLOWUP = re.compile(
+        r'FOLLOW-UP(?: [0-9]+)?:\s*(?P<question>(?:(?!FOLLOW-UP(?: [0-9]+)?:).)*?)'
+        r'FOLLOW-UP ANSWER(?: [0-9]+)?:\s*(?P<answer>(?:(?!FOLLOW-UP(?: [0-9]+)?:).)*)',
+        re.DOTALL
+    )
+    _NUM_PREFIX = re.compile(r'^[0-9]+\.?\s*')
+    _BLANKS = re.compile(r'\n\n+')
+    
+    @staticmethod
+    def split_by_word_count(text: str, words_per_chunk: int) -> Iterator[str]:
+        """Lazily split text into chunks based on word count.
+        
+        A single regex pass matches up to ``words_per_chunk`` words at a time,
+        so no list of every word in the text is built. Words are joined with
+        single spaces, giving the same chunks as ``iter_word_chunks``.
+        """
+        # re caches compiled patterns, so repeated calls with the same size don't recompile
+        for match in re.finditer(r'\S+(?:\s+\S+){0,%d}' % (words_per_chunk - 1), text):
+            yield ' '.join(match.group().split())
+    
+    @staticmethod
+    def iter_word_chunks(pieces: Iterable[str], words_per_chunk: int) -> Iterator[str]:
+        """Lazily split a stream of text pieces (pages, lines) into word-count chunks.
+        
+        Only the words of the chunk being assembled are held in memory, so the
+        full document never has to be materialized as one string.
+        """
+        words = []
+        for piece in pieces:
+            words.extend(piece.split())
+            if len(words) >= words_per_chunk:
+                # Join whole chunks from list slices, then drop them in one go
+                full = len(words) - len(words) % words_per_chunk
+                for start in range(0, full, words_per_chunk):
+                    yield ' '.join(words[start:start + words_per_chunk])
+                del words[:full]
+        
+        if words:
+            yield ' '.join(words)
+    
     @staticmethod
-    def split_by_word_count(text: str, words_per_chunk: int) -> List[str]:
-        """Split text into chunks based on word count."""
-        words = text.split()
-        chunks = []
+    def iter_token_chunks(pieces: Iterable[str], tokens_per_chunk: int) -> Iterator[str]:
+        """Lazily split a stream of text pieces into chunks of at most ``tokens_per_chunk`` tokens.
         
-        for i in range(0, len(words), words_per_chunk):
-            chunk = ' '.join(words[i:i + words_per_chunk])
-            if chunk.strip():
-                chunks.append(chunk.strip())
+        Tokens are counted with tiktoken's cl100k_base encoding, a close
+        estimate for all providers. Chunks still end on word boundaries.
+        """
+        words = []
+        num_tokens = 0
+        for piece in pieces:
+            for word in piece.split():
+                word_tokens = _count_word_tokens(word)
+                if words and num_tokens + word_tokens > tokens_per_chunk:
+                    yield ' '.join(words)
+                    words = []
+                    num_tokens = 0
+                words.append(word)
+                num_tokens += word_tokens
         
-        return chunks
+        if words:
+            yield ' '.join(words)
     
     @staticmethod
-    def create_prompt_template(custom_prompt: str, num_questions: int, num_exchanges: int) -> str:
-        """Create prompt template for Q&A generation."""
-        if num_exchanges == 1:
+    def dedupe_chunks(chunks: List[str]) -> Tuple[List[str], List[int]]:
+        """Drop repeated chunks, ignoring case and surrounding whitespace.
+        
+        Returns the unique chunks in first-seen order and, for every input
+        chunk, the index of its unique chunk.
+        """
+        unique_index = {}
+        unique_chunks = []
+        sources = []
+        for chunk in chunks:
+            key = hashlib.sha256(chunk.strip().lower().encode("utf-8")).digest()
+            if key not in unique_index:
+                unique_index[key] = len(unique_chunks)
+                unique_chunks.append(chunk)
+            sources.append(unique_index[key])
+        return unique_chunks, sources
+    
+    @staticmethod
+    def followup_keys(num_exchanges: int) -> List[Tuple[str, str]]:
+        """Conversation keys of the (question, answer) follow-up turns after the first exchange."""
+        return [
+            ('followup_question', 'followup_answer') if i == 1 else (f'followup_question_{i}', f'followup_answer_{i}')
+            for i in range(1, num_exchanges)
+        ]
+    
+    @staticmethod
+    def conversation_fields(num_exchanges: int) -> List[str]:
+        """All keys of a parsed conversation, in turn order."""
+        fields = ['question', 'answer']
+        for question_key, answer_key in TextProcessor.followup_keys(num_exchanges):
+            fields += [question_key, answer_key]
+        return fields
+    
+    @staticmethod
+    def create_prompt_template(custom_prompt: str, num_questions: int, num_exchanges: int,
+                               structured_output: bool = False) -> str:
+        """Create prompt template for Q&A generation.
+        
+        With ``structured_output`` the model is asked for JSON matching
+        ``get_response_schema`` instead of the labelled text format. The chunk
+        comes last so every prompt of a run shares the same instruction prefix,
+        which providers can serve from their prompt cache.
+        """
+        if structured_output:
+            fields = '"question" (user question, all lowercase) and "answer" (AI response based on text)'
+            followup_keys = TextProcessor.followup_keys(num_exchanges)
+            if followup_keys:
+                pairs = ', then '.join(f'"{question_key}" and "{answer_key}"' for question_key, answer_key in followup_keys)
+                fields += f', plus the follow-up turns in order: {pairs} (follow-up questions all lowercase, answers also based on text)'
+            format_instructions = f"""
+Format:
+Return a JSON object with a "conversations" array. Each conversation is an object with {fields}.
+"""
+        elif num_exchanges == 1:
             format_instructions = """
 Format for each conversation:
 CONVERSATION X:
@@ -33,13 +170,17 @@ QUESTION: [user question, all lowercase]
 ANSWER: [AI response based on text]
 """
         else:
+            followup_block = '\n'.join(
+                'FOLLOW-UP: [follow-up question, all lowercase]\n'
+                'FOLLOW-UP ANSWER: [AI response to follow-up, also based on text]'
+                for _ in range(num_exchanges - 1)
+            )
             format_instructions = f"""
-Format for each conversation:
+Format for each conversation ({num_exchanges - 1} follow-up(s) after the first answer):
 CONVERSATION X:
 QUESTION: [initial question from user, all lowercase]
 ANSWER: [AI response based on text]
-{'FOLLOW-UP: [follow-up question, all lowercase]' * (num_exchanges - 1)}
-{'FOLLOW-UP ANSWER: [AI response to follow-up, also based on text]' * (num_exchanges - 1)}
+{followup_block}
 """
         
         return f"""
@@ -54,75 +195,205 @@ Requirements:
 - Each conversation should feel natural and educational
 
 {format_instructions}
+Generate exactly {num_questions} conversations that thoroughly cover the content.
 
 Text content:
 {{chunk}}
-
-Generate exactly {num_questions} conversations that thoroughly cover the content:
 """
     
+    @staticmethod
+    def create_batched_prompt_template(custom_prompt: str, num_questions: int, num_exchanges: int,
+                                       num_chunks: int, structured_output: bool = False) -> str:
+        """Create a prompt template that asks for conversations about several chunks at once.
+        
+        Fill ``{chunk}`` with ``join_chunks``; the answers are split apart again
+        with ``split_batched_response``.
+        """
+        if structured_output:
+            batch_instructions = f"""
+The text content below contains {num_chunks} chunks separated by lines containing only {TextProcessor.CHUNK_BOUNDARY}.
+Treat each chunk independently and generate {num_questions} conversations for every chunk.
+Return a JSON object with a "chunks" array holding one object per chunk, in order, each in the format below.
+"""
+        else:
+            batch_instructions = f"""
+The text content below contains {num_chunks} chunks separated by lines containing only {TextProcessor.CHUNK_BOUNDARY}.
+Treat each chunk independently and generate {num_questions} conversations for every chunk.
+Answer the chunks in order and put a line containing only {TextProcessor.CHUNK_BOUNDARY} between the conversations of consecutive chunks.
+"""
+        return batch_instructions + TextProcessor.create_prompt_template(
+            custom_prompt, num_questions, num_exchanges, structured_output=structured_output
+        )
+    
+    @staticmethod
+    def join_chunks(chunks: List[str]) -> str:
+        """Number chunks and join them with the boundary marker for a multi-chunk prompt."""
+        return f"\n\n{TextProcessor.CHUNK_BOUNDARY}\n\n".join(
+            f"CHUNK {i}:\n{chunk}" for i, chunk in enumerate(chunks, start=1)
+        )
+    
+    @staticmethod
+    def split_batched_response(response_text: str, num_chunks: int, structured_output: bool = False) -> List[str]:
+        """Split a multi-chunk response into one single-chunk response per chunk.
+        
+        Each part has the same shape as the answer to a single-chunk prompt, so
+        it can be parsed and cached like one. Parts are matched to chunks by
+        position, so unless the response has exactly one part per chunk none
+        can be trusted and all of them are returned as empty strings.
+        """
+        if structured_output:
+            try:
+                data = json.loads(response_text)
+            except ValueError:
+                data = {}
+            items = data.get('chunks', []) if isinstance(data, dict) else []
+            parts = [json.dumps(item) if isinstance(item, dict) else '' for item in items]
+        else:
+            parts = [part.strip() for part in response_text.split(TextProcessor.CHUNK_BOUNDARY)]
+            # A boundary line before the first or after the last answer leaves an empty end part
+            while parts and not parts[0]:
+                parts.pop(0)
+            while parts and not parts[-1]:
+                parts.pop()
+        if len(parts) != num_chunks:
+            return [''] * num_chunks
+        return parts
+    
+    @staticmethod
+    def create_format_retry_prompt(prompt: str) -> str:
+        """Repeat a prompt whose response could not be parsed, with a reminder to follow the format."""
+        return (
+            f"{prompt}\n"
+            "Your previous answer to this request could not be parsed. Answer again, following the "
+            "required format exactly and without any other text.\n"
+        )
+    
+    @staticmethod
+    def get_response_schema(num_exchanges: int) -> Dict:
+        """JSON schema of a structured response for the given number of exchanges."""
+        fields = TextProcessor.conversation_fields(num_exchanges)
+        return {
+            "type": "object",
+            "properties": {
+                "conversations": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {field: {"type": "string"} for field in fields},
+                        "required": fields
+                    }
+                }
+            },
+            "required": ["conversations"]
+        }
+    
+    @staticmethod
+    def get_batched_response_schema(num_exchanges: int) -> Dict:
+        """JSON schema of a structured multi-chunk response."""
+        return {
+            "type": "object",
+            "properties": {
+                "chunks": {"type": "array", "items": TextProcessor.get_response_schema(num_exchanges)}
+            },
+            "required": ["chunks"]
+        }
+    
+    @staticmethod
+    def _clean_question(question: str) -> str:
+        """Drop list numbering and lowercase a question captured after its label."""
+        # The patterns already skip leading whitespace, so one trailing strip is enough
+        return TextProcessor._NUM_PREFIX.sub('', question, count=1).rstrip().lower()
+    
+    @staticmethod
+    def _clean_answer(answer: str) -> str:
+        """Collapse runs of blank lines in an answer captured after its label."""
+        answer = answer.rstrip()
+        if '\n\n\n' in answer:
+            answer = TextProcessor._BLANKS.sub('\n\n', answer)
+        return answer
+    
     @staticmethod
     def parse_qa_response(response_text: str, num_exchanges: int) -> List[Dict]:
         """Parse response into structured conversation pairs."""
+        followup_keys = TextProcessor.followup_keys(num_exchanges)
         conversations = []
         
-        # Split by CONVERSATION to find each conversation
-        parts = response_text.split('CONVERSATION')[1:]  # Skip first empty part
+        for match in TextProcessor._CONVERSATION.finditer(response_text):
+            answer = match['answer']
+            conversation = {'question': TextProcessor._clean_question(match['question'])}
+            if followup_keys:
+                followups = list(islice(TextProcessor._FOLLOWUP.finditer(answer), len(followup_keys)))
+                if len(followups) < len(followup_keys):
+                    continue
+                conversation['answer'] = TextProcessor._clean_answer(answer[:followups[0].start()])
+                for (question_key, answer_key), followup in zip(followup_keys, followups):
+                    conversation[question_key] = TextProcessor._clean_question(followup['question'])
+                    conversation[answer_key] = TextProcessor._clean_answer(followup['answer'])
+                # The last answer runs to the end of the conversation, as a plain split would take it
+                conversation[followup_keys[-1][1]] = TextProcessor._clean_answer(answer[followups[-1].start('answer'):])
+            else:
+                conversation['answer'] = TextProcessor._clean_answer(answer)
+            
+            if all(conversation.values()):
+                conversations.append(conversation)
         
-        for part in parts:
-            try:
-                if num_exchanges == 1:
-                    # Parse single exchange conversation
-                    if 'QUESTION:' in part and 'ANSWER:' in part:
-                        sections = part.split('QUESTION:', 1)[1]
-                        
-                        if 'ANSWER:' in sections:
-                            question_part, answer_part = sections.split('ANSWER:', 1)
-                            question = question_part.strip()
-                            answer = answer_part.strip()
-                            
-                            # Clean up formatting
-                            question = re.sub(r'^[0-9]+\.?\s*', '', question).strip().lower()
-                            answer = re.sub(r'\n\n+', '\n\n', answer).strip()
-                            
-                            if question and answer:
-                                conversations.append({
-                                    'question': question,
-                                    'answer': answer
-                                })
-                else:
-                    # Parse multi-exchange conversation
-                    if 'QUESTION:' in part and 'ANSWER:' in part:
-                        sections = part.split('QUESTION:', 1)[1]
-                        
-                        if 'ANSWER:' in sections:
-                            question_part, rest = sections.split('ANSWER:', 1)
-                            question = question_part.strip()
-                            
-                            # Extract first answer
-                            if 'FOLLOW-UP:' in rest:
-                                answer_part, followup_rest = rest.split('FOLLOW-UP:', 1)
-                                answer = answer_part.strip()
-                                
-                                if 'FOLLOW-UP ANSWER:' in followup_rest:
-                                    followup_question_part, followup_answer_part = followup_rest.split('FOLLOW-UP ANSWER:', 1)
-                                    followup_question = followup_question_part.strip()
-                                    followup_answer = followup_answer_part.strip()
-                                    
-                                    # Clean up formatting
-                                    question = re.sub(r'^[0-9]+\.?\s*', '', question).strip().lower()
-                                    answer = re.sub(r'\n\n+', '\n\n', answer).strip()
-                                    followup_question = re.sub(r'^[0-9]+\.?\s*', '', followup_question).strip().lower()
-                                    followup_answer = re.sub(r'\n\n+', '\n\n', followup_answer).strip()
-                                    
-                                    if question and answer and followup_question and followup_answer:
-                                        conversations.append({
-                                            'question': question,
-                                            'answer': answer,
-                                            'followup_question': followup_question,
-                                            'followup_answer': followup_answer
-                                        })
-            except Exception as e:
+        return conversations
+    
+    @staticmethod
+    def parse_json_response(response_text: str, num_exchanges: int) -> List[Dict]:
+        """Parse a structured (JSON mode) response into conversation pairs."""
+        try:
+            data = json.loads(response_text)
+        except ValueError:
+            return []
+        
+        items = data.get('conversations', []) if isinstance(data, dict) else data
+        fields = TextProcessor.conversation_fields(num_exchanges)
+        conversations = []
+        
+        for item in items if isinstance(items, list) else []:
+            if not isinstance(item, dict) or not all(isinstance(item.get(field), str) for field in fields):
                 continue
+            conversation = {field: item[field].strip() for field in fields}
+            conversation['question'] = conversation['question'].lower()
+            for question_key, _ in TextProcessor.followup_keys(num_exchanges):
+                conversation[question_key] = conversation[question_key].lower()
+            
+            if all(conversation.values()):
+                conversations.append(conversation)
         
-        return conversations 
\ No newline at end of file
+        return conversations
+
+
+class StreamingQAParser:
+    """Parses a text-format response incrementally while it is streamed.
+    
+    A conversation is complete once the next CONVERSATION marker arrives, so
+    everything before the latest marker is parsed as soon as it is received.
+    """
+    
+    def __init__(self, num_exchanges: int):
+        """Start parsing a new response."""
+        self.num_exchanges = num_exchanges
+        self._pieces: List[str] = []
+        self._pending = ""
+    
+    @property
+    def text(self) -> str:
+        """Full response text received so far."""
+        return "".join(self._pieces)
+    
+    def feed(self, delta: str) -> List[Dict]:
+        """Add streamed text and return the conversations it completed."""
+        self._pieces.append(delta)
+        self._pending += delta
+        cut = self._pending.rfind('CONVERSATION')
+        if cut <= 0:
+            return []
+        complete, self._pending = self._pending[:cut], self._pending[cut:]
+        return TextProcessor.parse_qa_response(complete, self.num_exchanges)
+    
+    def close(self) -> List[Dict]:
+        """Return the conversations left in the final part of the response."""
+        complete, self._pending = self._pending, ""
+        return TextProcessor.parse_qa_response(complete, self.num_exchanges)